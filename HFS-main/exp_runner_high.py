@@ -1,4 +1,6 @@
 import os
+import atexit
+import re
 import time
 import logging
 import argparse
@@ -6,9 +8,9 @@ import numpy as np
 import cv2 as cv
 import trimesh
 import torch
-import torch.nn.functional as F
 from torch.utils.tensorboard import SummaryWriter
 from shutil import copyfile
+from concurrent.futures import ThreadPoolExecutor
 from icecream import ic
 from tqdm import tqdm
 from pyhocon import ConfigFactory
@@ -24,10 +26,7 @@ from third_party import pytorch_ssim
 import matplotlib
 matplotlib.use('Agg')
 
-def mse2psnr(mse):
-    mse = np.maximum(mse, 1e-10)  # avoid -inf or nan when mse is very small.
-    psnr = -10.0 * np.log10(mse)
-    return psnr.astype(np.float32)
+CKPT_NAME_PATTERN = re.compile(r'ckpt_(\d+)\.pth$')
 
 class Runner:
     def __init__(self, conf_path, mode='train', case='CASE_NAME', is_continue=False, ckpt_name=None, base_exp_dir=None, end_iter=None):
@@ -48,9 +47,17 @@ class Runner:
         else:
             self.base_exp_dir = self.conf['general.base_exp_dir']
         os.makedirs(self.base_exp_dir, exist_ok=True)
+        # Text logs stay open (line buffered) for the whole run instead of being reopened at every report
+        os.makedirs(os.path.join(self.base_exp_dir, 'logs'), exist_ok=True)
+        self.loss_file = open(os.path.join(self.base_exp_dir, 'logs', 'loss.txt'), 'a', buffering=1)
+        self.metric_file = open(os.path.join(self.base_exp_dir, 'logs', 'image_metric.txt'), 'a', buffering=1)
+        atexit.register(self.loss_file.close)
+        atexit.register(self.metric_file.close)
         self.dataset = Dataset(self.conf['dataset'])
-        self.train_images = self.dataset.images.cuda()
         self.iter_step = 0
+        self.perm_generator = torch.Generator(device=self.device)
+        self.perm_generator.manual_seed(0)
+        self.image_perm = torch.empty([self.dataset.n_images], dtype=torch.long, device=self.device)
 
         # Training parameters
         if end_iter is not None:
@@ -67,8 +74,17 @@ class Runner:
         self.learning_rate = self.conf.get_float('train.learning_rate')
         self.learning_rate_alpha = self.conf.get_float('train.learning_rate_alpha')
         self.use_white_bkgd = self.conf.get_bool('train.use_white_bkgd')
+        self.background_rgb = torch.ones([1, 3], device=self.device) if self.use_white_bkgd else None
         self.warm_up_end = self.conf.get_float('train.warm_up_end', default=0.0)
         self.anneal_end = self.conf.get_float('train.anneal_end', default=0.0)
+        self.use_compile = self.conf.get_bool('train.use_compile', default=False) and hasattr(torch, 'compile')
+        # bf16 autocast only by default where the GPU has native bf16; emulated bf16 is slower than fp32
+        try:
+            native_bf16 = torch.cuda.is_bf16_supported(including_emulation=False)
+        except TypeError:
+            # Older torch has no emulation path and only reports native support
+            native_bf16 = torch.cuda.is_bf16_supported()
+        self.use_amp = self.conf.get_bool('train.use_amp', default=native_bf16)
 
         # Weights
         self.igr_weight = self.conf.get_float('train.igr_weight')
@@ -78,6 +94,9 @@ class Runner:
         self.mode = mode
         self.model_list = []
         self.writer = None
+        self.image_writer = ThreadPoolExecutor(max_workers=4)
+        self.last_progress = -1.0  # progress last written to the networks, to skip redundant fills
+        self.pending_scalars = []  # (tag, step, detached 0-d tensor), flushed every report_freq iterations
 
         # Networks
         params_to_train = []
@@ -87,7 +106,15 @@ class Runner:
         self.deviation_network = SingleVarianceNetwork(**self.conf['model.variance_network']).to(self.device)
         self.color_network = RenderingNetwork(**self.conf['model.rendering_network']).to(self.device)
 
-        self.lpips_vgg_fn = lpips_lib.LPIPS(net='vgg').to(self.device)  # net="alex"
+        if self.use_compile:
+            # Compile forward in place so state_dict keys (and old checkpoints) are unchanged. The SDF networks stay
+            # eager: their gradient() is differentiated again by the eikonal loss, and compiled graphs do not
+            # support double backward.
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.join(self.base_exp_dir, 'inductor_cache'))
+            for network in [self.nerf_outside, self.deviation_network, self.color_network]:
+                network.forward = torch.compile(network.forward, dynamic=False)
+
+        self.lpips_vgg = None  # loaded on first full-resolution validation, see lpips_vgg_fn
 
         params_to_train += list(self.nerf_outside.parameters())
         params_to_train += list(self.sdf_network.parameters())
@@ -95,7 +122,16 @@ class Runner:
         params_to_train += list(self.deviation_network.parameters())
         params_to_train += list(self.color_network.parameters())
 
-        self.optimizer = torch.optim.Adam(params_to_train, lr=self.learning_rate)
+        # Fused Adam runs the element-wise update as one multi-tensor kernel; fall back to apex (or the stock
+        # implementation) on torch builds without the fused path.
+        try:
+            self.optimizer = torch.optim.Adam(params_to_train, lr=self.learning_rate, fused=True)
+        except (TypeError, RuntimeError):
+            try:
+                from apex.optimizers import FusedAdam
+                self.optimizer = FusedAdam(params_to_train, lr=self.learning_rate)
+            except ImportError:
+                self.optimizer = torch.optim.Adam(params_to_train, lr=self.learning_rate)
 
         self.renderer = NeuSRenderer(self.nerf_outside,
                                      self.sdf_network,
@@ -109,18 +145,17 @@ class Runner:
         if is_continue:
             if self.ckpt_name is not None:
                 latest_model_name = self.ckpt_name
-            else:
-                model_list_raw = os.listdir(os.path.join(self.base_exp_dir, 'checkpoints'))
-                model_list = []
-                num = -1
-                for model_name in model_list_raw:
-                    iter = int(model_name[5:-4])
-                    if model_name[-3:] == 'pth' and iter <= self.end_iter:
-                        if iter > num:
-                            num = iter
-                            model_list = model_name
-                # model_list.sort()
-                latest_model_name = model_list  # [-1]
+            elif os.path.isdir(os.path.join(self.base_exp_dir, 'checkpoints')):
+                latest_iter = -1
+                with os.scandir(os.path.join(self.base_exp_dir, 'checkpoints')) as entries:
+                    for entry in entries:
+                        match = CKPT_NAME_PATTERN.match(entry.name)
+                        if match is None:
+                            continue
+                        ckpt_iter = int(match.group(1))
+                        if latest_iter < ckpt_iter <= self.end_iter:
+                            latest_iter = ckpt_iter
+                            latest_model_name = entry.name
 
         if latest_model_name is not None:
             logging.info('Find checkpoint: {}'.format(latest_model_name))
@@ -130,8 +165,16 @@ class Runner:
         if self.mode[:5] == 'train' and not is_continue:
             self.file_backup()
 
+    @property
+    def lpips_vgg_fn(self):
+        """
+        LPIPS(VGG) metric, only loaded when first needed so training does not hold its weights on the GPU.
+        """
+        if self.lpips_vgg is None:
+            self.lpips_vgg = lpips_lib.LPIPS(net='vgg').to(self.device)  # net="alex"
+        return self.lpips_vgg
+
     def train(self):
-        lpips_vgg_fn = self.lpips_vgg_fn
         self.writer = SummaryWriter(log_dir=os.path.join(self.base_exp_dir, 'logs'))
         self.update_learning_rate()
         image_perm = self.get_image_perm()
@@ -143,20 +186,19 @@ class Runner:
         stt = self.iter_step
         nd = self.end_iter
 
-        iter_i = stt
-        while iter_i in tqdm(range(stt, nd)):
+        for iter_i in tqdm(range(stt, nd)):
 
-            idx_list = image_perm[self.iter_step % len(image_perm)]
+            idx_list = image_perm[iter_i % len(image_perm)]
 
-            data, intrinsic, intrinsic_inv, pose, image_gray = self.dataset.gen_random_rays_at(idx_list, self.batch_size)
+            rays, intrinsic, intrinsic_inv, pose, image_gray = self.dataset.gen_random_rays_at(idx_list, self.batch_size)
+            # Reshuffle at the epoch boundary before prefetching, so the prefetch targets the next epoch's first view
+            if (iter_i+1) % len(image_perm) == 0:
+                image_perm = self.get_image_perm()
+            self.dataset.image_pool.prefetch(image_perm[(iter_i + 1) % len(image_perm)])
 
-            rays_o, rays_d, true_rgb, mask = data[:, :3], data[:, 3: 6], data[:, 6: 9], data[:, 9: 10]
+            rays_o, rays_d, true_rgb, mask = rays
             near, far = self.dataset.near_far_from_sphere(rays_o, rays_d)
 
-            background_rgb = None
-            if self.use_white_bkgd:
-                background_rgb = torch.ones([1, 3])
-
             if self.mask_weight > 0.0:
                 mask = (mask > 0.5).float()
             else:
@@ -164,71 +206,74 @@ class Runner:
 
             mask_sum = mask.sum() + 1e-5
 
-            render_out = self.renderer.render(rays_o, rays_d, near, far,
-                                              background_rgb=background_rgb,
-                                              cos_anneal_ratio=self.get_cos_anneal_ratio(), intrinsics=intrinsic, intrinsics_inv=intrinsic_inv, poses=pose, images=image_gray)
+            with torch.autocast(device_type='cuda', dtype=torch.bfloat16, enabled=self.use_amp):
+                render_out = self.renderer.render(rays_o, rays_d, near, far,
+                                                  background_rgb=self.background_rgb,
+                                                  cos_anneal_ratio=self.get_cos_anneal_ratio(), intrinsics=intrinsic, intrinsics_inv=intrinsic_inv, poses=pose, images=image_gray)
             
-            img_idx_d = self.iter_step % len(image_perm)
+                img_idx_d = self.iter_step % len(image_perm)
 
 
-            pts_view = self.dataset.gen_pts_view(img_idx_d)
-            pts2sdf = self.renderer.sdf_network.sdf(pts_view)
+                pts_view = self.dataset.gen_pts_view(img_idx_d)
+                pts2sdf = self.renderer.sdf_network.sdf(pts_view)
 
 
-            color_fine = render_out['color_fine']
-            s_val = render_out['s_val']
-            cdf_fine = render_out['cdf_fine']
-            gradient_error = render_out['gradient_error']
-            weight_max = render_out['weight_max']
-            weight_sum = render_out['weight_sum']
-            ncc_cost = render_out['ncc_cost']
-            inside_sphere = render_out['mid_inside_sphere']
-            # Loss
-            color_error = (color_fine - true_rgb) * mask
-            color_fine_loss = F.l1_loss(color_error, torch.zeros_like(color_error), reduction='sum') / mask_sum
-            psnr = 20.0 * torch.log10(1.0 / (((color_fine - true_rgb) ** 2 * mask).sum() / (mask_sum * 3.0)).sqrt())
+                color_fine = render_out['color_fine']
+                s_val = render_out['s_val']
+                cdf_fine = render_out['cdf_fine']
+                gradient_error = render_out['gradient_error']
+                weight_max = render_out['weight_max']
+                weight_sum = render_out['weight_sum']
+                ncc_cost = render_out['ncc_cost']
+                inside_sphere = render_out['mid_inside_sphere']
+                # Loss
+                color_diff = color_fine - true_rgb
+                color_error = color_diff * mask
+                color_fine_loss = color_error.abs().sum() / mask_sum
+                psnr = 20.0 * torch.log10(1.0 / ((color_error * color_diff).sum() / (mask_sum * 3.0)).sqrt())  # mask is 0/1
 
-            eikonal_loss = gradient_error
+                eikonal_loss = gradient_error
 
-            mask_loss = F.binary_cross_entropy(weight_sum.clip(1e-3, 1.0 - 1e-3), mask)
+                # Binary cross entropy of weight_sum clipped to [1e-3, 1 - 1e-3]; 1 - clip(w) == clip(1 - w), so both
+                # log terms match F.binary_cross_entropy on the clipped input, including zero gradient when saturated
+                mask_loss = -(mask * torch.log(weight_sum.clamp(1e-3, 1.0 - 1e-3)) +
+                              (1.0 - mask) * torch.log((1.0 - weight_sum).clamp(1e-3, 1.0 - 1e-3))).mean()
 
-            sdf_loss = F.l1_loss(pts2sdf, torch.zeros_like(pts2sdf),
-                                   reduction='sum') / pts2sdf.shape[0]
+                sdf_loss = pts2sdf.abs().sum() / pts2sdf.shape[0]
 
-            ncc_loss = 0.5 * (ncc_cost.sum(dim=0) / (inside_sphere.sum(dim=0) + 1e-8)).squeeze(-1)
+                ncc_loss = 0.5 * (ncc_cost.sum(dim=0) / (inside_sphere.sum(dim=0) + 1e-8)).squeeze(-1)
 
-            loss = color_fine_loss +\
-                   eikonal_loss * self.igr_weight +\
-                   mask_loss * self.mask_weight +\
-                   sdf_loss +\
-                   ncc_loss
+                loss = color_fine_loss +\
+                       eikonal_loss * self.igr_weight +\
+                       mask_loss * self.mask_weight +\
+                       sdf_loss +\
+                       ncc_loss
 
 
-            self.optimizer.zero_grad()
+            self.optimizer.zero_grad(set_to_none=True)
 
             loss.backward()
             self.optimizer.step()
 
             self.iter_step += 1
 
-            self.writer.add_scalar('Loss/loss', loss, self.iter_step)
-            self.writer.add_scalar('Loss/color_loss', color_fine_loss, self.iter_step)
-            self.writer.add_scalar('Loss/eikonal_loss', eikonal_loss, self.iter_step)
-            self.writer.add_scalar('Loss/sdf_loss', sdf_loss, self.iter_step)
-            self.writer.add_scalar('Loss/ncc_loss', ncc_loss, self.iter_step)
-            self.writer.add_scalar('Statistics/s_val', s_val.mean(), self.iter_step)
-            self.writer.add_scalar('Statistics/cdf', (cdf_fine[:, :1] * mask).sum() / mask_sum, self.iter_step)
-            self.writer.add_scalar('Statistics/weight_max', (weight_max * mask).sum() / mask_sum, self.iter_step)
-            self.writer.add_scalar('Statistics/psnr', psnr, self.iter_step)
+            self.add_scalar('Loss/loss', loss)
+            self.add_scalar('Loss/color_loss', color_fine_loss)
+            self.add_scalar('Loss/eikonal_loss', eikonal_loss)
+            self.add_scalar('Loss/sdf_loss', sdf_loss)
+            self.add_scalar('Loss/ncc_loss', ncc_loss)
+            self.add_scalar('Statistics/s_val', s_val.mean())
+            self.add_scalar('Statistics/cdf', (cdf_fine[:, :1] * mask).sum() / mask_sum)
+            self.add_scalar('Statistics/weight_max', (weight_max * mask).sum() / mask_sum)
+            self.add_scalar('Statistics/psnr', psnr)
 
             if self.iter_step % self.report_freq == 0 or self.iter_step == 1:
+                latest = self.flush_scalars()
                 print(self.base_exp_dir)
-                outstr = 'iter:{:8>d} loss = {} lr={}\n'.format(self.iter_step, loss,
+                outstr = 'iter:{:8>d} loss = {} lr={}\n'.format(self.iter_step, latest['Loss/loss'],
                                                                 self.optimizer.param_groups[0]['lr'])
                 print(outstr)
-                f = os.path.join(self.base_exp_dir, 'logs', 'loss.txt')
-                with open(f, 'a') as file:
-                    file.write(outstr)
+                self.loss_file.write(outstr)
 
             if self.iter_step % self.save_freq == 0 or self.iter_step == 1:
                 self.save_checkpoint()
@@ -248,19 +293,50 @@ class Runner:
                 progress_data = 1.0
             else:
                 progress_data = 0.5 + self.iter_step / (self.end_iter)
-            self.sdf_network.progress.data.fill_(progress_data)
-            self.sdf_network_high.progress.data.fill_(progress_data)
-            self.color_network.progress.data.fill_(progress_data)
+            if progress_data != self.last_progress:
+                self.sdf_network.progress.data.fill_(progress_data)
+                self.sdf_network_high.progress.data.fill_(progress_data)
+                self.color_network.progress.data.fill_(progress_data)
+                self.last_progress = progress_data
 
+        self.flush_scalars()
 
-            if (iter_i+1) % len(image_perm) == 0:
-                image_perm = self.get_image_perm()
 
-            iter_i = iter_i + 1
+    def add_scalar(self, tag, value):
+        """
+        Queue a scalar for TensorBoard without reading it back from the GPU.
+        """
+        self.pending_scalars.append((tag, self.iter_step, value.detach().reshape([])))
 
+    def flush_scalars(self):
+        """
+        Read all queued scalars back with a single device sync, write them out and return the latest value per tag.
+        """
+        if len(self.pending_scalars) == 0:
+            return {}
+        values = torch.stack([value.float() for _, _, value in self.pending_scalars]).tolist()
+        latest = {}
+        for (tag, step, _), value in zip(self.pending_scalars, values):
+            self.writer.add_scalar(tag, value, step)
+            latest[tag] = value
+        self.pending_scalars = []
+        return latest
+
+    def pad_rays(self, rays_o, rays_d):
+        """
+        Pad flattened rays up to a multiple of batch_size so compiled networks always see the shape they were
+        traced with.
+        """
+        n_pad = -len(rays_o) % self.batch_size
+        if not self.use_compile or n_pad == 0:
+            return rays_o, rays_d
+        rays_o = torch.cat([rays_o, rays_o[-1:].expand(n_pad, 3)], dim=0)
+        rays_d = torch.cat([rays_d, rays_d[-1:].expand(n_pad, 3)], dim=0)
+        return rays_o, rays_d
 
     def get_image_perm(self):
-        return torch.randperm(self.dataset.n_images)
+        # Reshuffled in place: the previous permutation is no longer valid after this call
+        return torch.randperm(self.dataset.n_images, generator=self.perm_generator, out=self.image_perm)
 
     def get_cos_anneal_ratio(self):
         if self.anneal_end == 0.0:
@@ -301,6 +377,14 @@ class Runner:
         self.deviation_network.load_state_dict(checkpoint['variance_network_fine'])
         self.color_network.load_state_dict(checkpoint['color_network_fine'])
         self.optimizer.load_state_dict(checkpoint['optimizer'])
+        if self.optimizer.defaults.get('fused'):
+            # load_state_dict takes the param groups from the checkpoint, which turns the fused path off again for
+            # checkpoints saved by an unfused optimizer; fused Adam also expects its step counters on the device
+            for group in self.optimizer.param_groups:
+                group['fused'] = True
+            for state in self.optimizer.state.values():
+                if 'step' in state:
+                    state['step'] = torch.as_tensor(state['step'], dtype=torch.float32, device=self.device)
         self.iter_step = checkpoint['iter_step']
 
         logging.info('End')
@@ -321,16 +405,13 @@ class Runner:
                    os.path.join(self.base_exp_dir, 'checkpoints', 'ckpt_{:0>6d}.pth'.format(self.iter_step)))
 
     def validate_image(self, idx=-1, resolution_level=-1):
-        lpips_vgg_fn = self.lpips_vgg_fn
         if idx < 0:
             idx = np.random.randint(self.dataset.n_images)
 
         outstr = 'Validate: iter: {}, camera: {}\n'.format(self.iter_step, idx)
         print(outstr)
         if resolution_level == 1:
-            f = os.path.join(self.base_exp_dir, 'logs', 'image_metric.txt')
-            with open(f, 'a') as file:
-                file.write(outstr)
+            self.metric_file.write(outstr)
 
         if resolution_level < 0:
             resolution_level = self.validate_resolution_level
@@ -338,82 +419,85 @@ class Runner:
 
         rays_o, rays_d, intrinsic, intrinsic_inv, pose, image_gray = self.dataset.gen_rays_at(idx, resolution_level=resolution_level)
         H, W, _ = rays_o.shape
-        rays_o = rays_o.reshape(-1, 3).split(self.batch_size)
-        rays_d = rays_d.reshape(-1, 3).split(self.batch_size)
-
-        out_rgb_fine = []
-        out_normal_fine = []
-        out_depth_fine = []
-        out_ncc_fine = []
-
-        for rays_o_batch, rays_d_batch in zip(rays_o, rays_d):
-            near, far = self.dataset.near_far_from_sphere(rays_o_batch, rays_d_batch)
-            background_rgb = torch.ones([1, 3]) if self.use_white_bkgd else None
-
-            render_out = self.renderer.render(rays_o_batch,
-                                              rays_d_batch,
-                                              near,
-                                              far,
+        n_rays = H * W
+        rays_o, rays_d = self.pad_rays(rays_o.reshape(-1, 3), rays_d.reshape(-1, 3))
+        near, far = self.dataset.near_far_from_sphere(rays_o, rays_d)
+
+        # Per-ray outputs, allocated on the first batch and filled slice by slice
+        out_rgb_fine = None
+        out_normal_fine = None
+        out_depth_fine = None
+        out_ncc_fine = None
+
+        for start in range(0, n_rays, self.batch_size):
+            end = start + self.batch_size
+            render_out = self.renderer.render(rays_o[start: end],
+                                              rays_d[start: end],
+                                              near[start: end],
+                                              far[start: end],
                                               cos_anneal_ratio=self.get_cos_anneal_ratio(),
-                                            background_rgb=background_rgb, intrinsics=intrinsic, intrinsics_inv=intrinsic_inv, poses=pose, images=image_gray)
+                                            background_rgb=self.background_rgb, intrinsics=intrinsic, intrinsics_inv=intrinsic_inv, poses=pose, images=image_gray)
 
             def feasible(key):
                 return (key in render_out) and (render_out[key] is not None)
 
+            def store(out, value):
+                if out is None:
+                    out = torch.empty([n_rays, *value.shape[1:]], dtype=value.dtype)
+                n_valid = min(end, n_rays) - start
+                out[start: start + n_valid] = value[:n_valid].detach()
+                return out
+
             if feasible('color_fine'):
-                out_rgb_fine.append(render_out['color_fine'].detach().cpu().numpy())
+                out_rgb_fine = store(out_rgb_fine, render_out['color_fine'])
             if feasible('gradients') and feasible('weights'):
                 n_samples = self.renderer.n_samples + self.renderer.n_importance
                 normals = render_out['gradients'] * render_out['weights'][:, :n_samples, None]
                 if feasible('inside_sphere'):
                     normals = normals * render_out['inside_sphere'][..., None]
-                normals = normals.sum(dim=1).detach().cpu().numpy()
-                # normals = (normals.sum(dim=1)**2).sum(dim=1,keepdim=True).sqrt().tile(1,3).detach().cpu().numpy()
-                out_normal_fine.append(normals)
+                # normals = (normals.sum(dim=1)**2).sum(dim=1,keepdim=True).sqrt().tile(1,3)
+                out_normal_fine = store(out_normal_fine, normals.sum(dim=1))
             if feasible('depth_sdf'):
-                out_depth_fine.append(render_out['depth_sdf'].detach().cpu().numpy())
+                out_depth_fine = store(out_depth_fine, render_out['depth_sdf'])
             if feasible('ncc_cost'):
-                out_ncc_fine.append(render_out['ncc_cost'].detach().cpu().numpy())
+                out_ncc_fine = store(out_ncc_fine, render_out['ncc_cost'])
             del render_out
 
         img_fine = None
-        if len(out_rgb_fine) > 0:
-            img_fine = (np.concatenate(out_rgb_fine, axis=0).reshape([H, W, 3, -1]) * 256).clip(0, 255)
+        if out_rgb_fine is not None:
+            # Metrics are computed on the GPU; only the final image is copied back for writing
+            color_fine = out_rgb_fine.reshape([H, W, 3])
+            img_fine = (color_fine.cpu().numpy().reshape([H, W, 3, -1]) * 256).clip(0, 255).astype(np.uint8)
             if resolution_level == 1:
-                color_fine = torch.from_numpy(np.concatenate(out_rgb_fine, axis=0).reshape([H, W, 3])).to(self.device)
-                true_rgb = self.dataset.images[idx].to(self.device)
+                true_rgb = self.dataset.images[idx].to(self.device, non_blocking=True)
                 color_error = color_fine - true_rgb
-                color_fine_loss = F.l1_loss(color_error, torch.zeros_like(color_error), reduction='mean')
+                color_fine_loss = color_error.abs().mean()
                 outstr = '{0:4d} img: loss: {1:.2f}\n'.format(idx, color_fine_loss)
                 print(outstr)
-                f = os.path.join(self.base_exp_dir, 'logs', 'image_metric.txt')
-                with open(f, 'a') as file:
-                    file.write(outstr)
-                mse = F.mse_loss(color_fine, true_rgb).item()
-                psnr = mse2psnr(mse)
+                self.metric_file.write(outstr)
+                mse = color_error.pow(2).mean()
+                psnr = (-10.0 * torch.log10(mse.clamp_min(1e-10))).item()  # avoid -inf or nan when mse is very small.
                 ssim = pytorch_ssim.ssim(color_fine.permute(2, 0, 1).unsqueeze(0), true_rgb.permute(2, 0, 1).unsqueeze(0)).item()
-                lpips_loss = lpips_vgg_fn(color_fine.permute(2, 0, 1).unsqueeze(0).contiguous(),
-                                          true_rgb.permute(2, 0, 1).unsqueeze(0).contiguous(), normalize=True).item()
+                lpips_loss = self.lpips_vgg_fn(color_fine.permute(2, 0, 1).unsqueeze(0).contiguous(),
+                                               true_rgb.permute(2, 0, 1).unsqueeze(0).contiguous(), normalize=True).item()
                 outstr = '{0:4d} img: PSNR: {1:.2f}, SSIM: {2:.2f}, LPIPS {3:.2f}\n'.format(idx, psnr, ssim, lpips_loss)
                 print(outstr)
-                f = os.path.join(self.base_exp_dir, 'logs', 'image_metric.txt')
-                with open(f, 'a') as file:
-                    file.write(outstr)
-        depth_fine = None
-        if len(out_depth_fine) > 0:
-            depth_fine = np.concatenate(out_depth_fine, axis=0).reshape([H, W, 1, -1])
-            depth_fine[depth_fine < 0] = 0
-        
-        ncc_cost = None
-        if len(out_ncc_fine) > 0:
-            ncc_cost = np.concatenate(out_ncc_fine, axis=0).reshape([H, W, 1, -1])
+                self.metric_file.write(outstr)
+        depth_img = None
+        if out_depth_fine is not None:
+            depth_fine = out_depth_fine.cpu().numpy().reshape([H, W, 1, -1]).clip(0, None)
+            depth_img = (255 * depth_fine / depth_fine.max(axis=(0, 1, 2), keepdims=True)).astype(np.uint8)
+
+        ncc_img = None
+        if out_ncc_fine is not None:
+            ncc_img = (255 * out_ncc_fine.cpu().numpy().reshape([H, W, 1, -1]) / 2.0).astype(np.uint8)
 
         normal_img = None
-        if len(out_normal_fine) > 0:
-            normal_img = np.concatenate(out_normal_fine, axis=0)
+        if out_normal_fine is not None:
+            normal_img = out_normal_fine.cpu().numpy()
             rot = np.linalg.inv(self.dataset.pose_all[idx, :3, :3].detach().cpu().numpy())
             normal_img = (np.matmul(rot[None, :, :], normal_img[:, :, None])
-                          .reshape([H, W, 3, -1]) * 128 + 128).clip(0, 255)
+                          .reshape([H, W, 3, -1]) * 128 + 128).clip(0, 255).astype(np.uint8)
             # maxv = normal_img.max()
             # normal_img = (normal_img[:, :, None]
             #               .reshape([H, W, 3, -1]) / maxv * 256).clip(0, 255)
@@ -423,29 +507,26 @@ class Runner:
         os.makedirs(os.path.join(self.base_exp_dir, 'depths'), exist_ok=True)
         os.makedirs(os.path.join(self.base_exp_dir, 'ncc_costs'), exist_ok=True)
 
+        # PNG encoding happens on the writer threads (OpenCV releases the GIL) while training resumes
         for i in range(img_fine.shape[-1]):
-            if len(out_rgb_fine) > 0:
-                cv.imwrite(os.path.join(self.base_exp_dir,
-                                        'validations_fine',
-                                        '{:0>8d}_{}_{}.png'.format(self.iter_step, i, idx)),
-                           np.concatenate([img_fine[..., i],
-                                           self.dataset.image_at(idx, resolution_level=resolution_level)]))
-            if len(out_normal_fine) > 0:
-                cv.imwrite(os.path.join(self.base_exp_dir,
-                                        'normals',
-                                        '{:0>8d}_{}_{}.png'.format(self.iter_step, i, idx)),
-                           normal_img[..., i])
-                
-            if len(out_depth_fine) > 0:
-                cv.imwrite(os.path.join(self.base_exp_dir,
-                                        'depths',
-                                        '{:0>8d}_{}_{}.png'.format(self.iter_step, i, idx)), (255 * depth_fine[..., i] / depth_fine[..., i].max()).astype(np.uint8))
-            if len(out_ncc_fine) > 0:
-                cv.imwrite(os.path.join(self.base_exp_dir,
-                                        'ncc_costs',
-                                        '{:0>8d}_{}_{}.png'.format(self.iter_step, i, idx)), (255 * ncc_cost[..., i] / 2.0).astype(np.uint8))
-
-
+            file_name = '{:0>8d}_{}_{}.png'.format(self.iter_step, i, idx)
+            if img_fine is not None:
+                self.image_writer.submit(cv.imwrite,
+                                         os.path.join(self.base_exp_dir, 'validations_fine', file_name),
+                                         np.concatenate([img_fine[..., i],
+                                                         self.dataset.image_at(idx, resolution_level=resolution_level)]))
+            if normal_img is not None:
+                self.image_writer.submit(cv.imwrite,
+                                         os.path.join(self.base_exp_dir, 'normals', file_name),
+                                         normal_img[..., i])
+            if depth_img is not None:
+                self.image_writer.submit(cv.imwrite,
+                                         os.path.join(self.base_exp_dir, 'depths', file_name),
+                                         depth_img[..., i])
+            if ncc_img is not None:
+                self.image_writer.submit(cv.imwrite,
+                                         os.path.join(self.base_exp_dir, 'ncc_costs', file_name),
+                                         ncc_img[..., i])
 
     def render_novel_image(self, idx_0, idx_1, ratio, resolution_level):
         """
@@ -454,26 +535,26 @@ class Runner:
 
         rays_o, rays_d = self.dataset.gen_rays_between(idx_0, idx_1, ratio, resolution_level=resolution_level)
         H, W, _ = rays_o.shape
-        rays_o = rays_o.reshape(-1, 3).split(self.batch_size)
-        rays_d = rays_d.reshape(-1, 3).split(self.batch_size)
-
-        out_rgb_fine = []
-        for rays_o_batch, rays_d_batch in zip(rays_o, rays_d):
-            near, far = self.dataset.near_far_from_sphere(rays_o_batch, rays_d_batch)
-            background_rgb = torch.ones([1, 3]) if self.use_white_bkgd else None
-
-            render_out = self.renderer.render(rays_o_batch,
-                                              rays_d_batch,
-                                              near,
-                                              far,
+        n_rays = H * W
+        rays_o, rays_d = self.pad_rays(rays_o.reshape(-1, 3), rays_d.reshape(-1, 3))
+        near, far = self.dataset.near_far_from_sphere(rays_o, rays_d)
+
+        out_rgb_fine = torch.empty([n_rays, 3])
+        for start in range(0, n_rays, self.batch_size):
+            end = start + self.batch_size
+            render_out = self.renderer.render(rays_o[start: end],
+                                              rays_d[start: end],
+                                              near[start: end],
+                                              far[start: end],
                                               cos_anneal_ratio=self.get_cos_anneal_ratio(),
-                                              background_rgb=background_rgb)
+                                              background_rgb=self.background_rgb)
 
-            out_rgb_fine.append(render_out['color_fine'].detach().cpu().numpy())
+            n_valid = min(end, n_rays) - start
+            out_rgb_fine[start: start + n_valid] = render_out['color_fine'][:n_valid].detach()
 
             del render_out
 
-        img_fine = (np.concatenate(out_rgb_fine, axis=0).reshape([H, W, 3]) * 256).clip(0, 255).astype(np.uint8)
+        img_fine = (out_rgb_fine.cpu().numpy().reshape([H, W, 3]) * 256).clip(0, 255).astype(np.uint8)
         return img_fine
 
     def validate_mesh(self, world_space=False, resolution=64, threshold=0.0):
@@ -3,6 +3,7 @@ import torch.nn.functional as F
 import cv2 as cv
 import numpy as np
 import os
+from collections import OrderedDict, namedtuple
 from glob import glob
 from icecream import ic
 from scipy.spatial.transform import Rotation as Rot
@@ -33,6 +34,60 @@ def load_K_Rt_from_P(filename, P=None):
     return intrinsics, pose
 
 
+# Rays sampled for one training step, each field its own [batch_size, C] tensor
+RayBatch = namedtuple('RayBatch', ['rays_o', 'rays_d', 'rgb', 'mask'])
+
+
+class ImagePool:
+    """
+    Keep a fixed number of training images (and masks) resident on the GPU.
+
+    The full image stack stays in pinned host memory; images are streamed into rotating GPU slots on a side stream
+    with non-blocking copies, so prefetching the next training view overlaps with the current iteration.
+    """
+    def __init__(self, images, masks, n_slots, device):
+        self.images = images
+        self.masks = masks
+        self.device = device
+        self.n_slots = min(max(n_slots, 2), images.shape[0])  # the current view and the prefetched one
+        self.slot_images = torch.empty([self.n_slots, *images.shape[1:]], dtype=images.dtype, device=device)
+        self.slot_masks = torch.empty([self.n_slots, *masks.shape[1:]], dtype=masks.dtype, device=device)
+        self.copy_stream = torch.cuda.Stream(device=device)
+        self.slot_ready = [torch.cuda.Event() for _ in range(self.n_slots)]
+        self.resident = OrderedDict()  # img_idx -> slot, least recently used first
+
+    def prefetch(self, img_idx):
+        """
+        Start copying an image into a GPU slot (if not already resident) and return the slot index.
+        """
+        img_idx = int(img_idx)
+        if img_idx in self.resident:
+            self.resident.move_to_end(img_idx)
+            return self.resident[img_idx]
+
+        if len(self.resident) < self.n_slots:
+            slot = len(self.resident)
+        else:
+            _, slot = self.resident.popitem(last=False)
+
+        # Do not overwrite the slot before the work already queued on the training stream has read it.
+        self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+        with torch.cuda.stream(self.copy_stream):
+            self.slot_images[slot].copy_(self.images[img_idx], non_blocking=True)
+            self.slot_masks[slot].copy_(self.masks[img_idx], non_blocking=True)
+            self.slot_ready[slot].record(self.copy_stream)
+        self.resident[img_idx] = slot
+        return slot
+
+    def get(self, img_idx):
+        """
+        Return the resident (image, mask) of one view, waiting on its copy if it is still in flight.
+        """
+        slot = self.prefetch(img_idx)
+        torch.cuda.current_stream(self.device).wait_event(self.slot_ready[slot])
+        return self.slot_images[slot], self.slot_masks[slot]
+
+
 class Dataset:
     def __init__(self, conf):
         super(Dataset, self).__init__()
@@ -47,6 +102,7 @@ class Dataset:
         num_views = conf.get_string('n_views')
         self.camera_outside_sphere = conf.get_bool('camera_outside_sphere', default=True)
         self.scale_mat_scale = conf.get_float('scale_mat_scale', default=1.1)
+        self.image_pool_size = conf.get_int('image_pool_size', default=2)
 
         camera_dict = np.load(os.path.join(self.data_dir, self.render_cameras_name))
         self.camera_dict = camera_dict
@@ -75,9 +131,10 @@ class Dataset:
             self.intrinsics_all.append(torch.from_numpy(intrinsics).float())
             self.pose_all.append(torch.from_numpy(pose).float())
 
-        self.images = torch.from_numpy(self.images_np.astype(np.float32)).to(self.device)
+        self.images = torch.from_numpy(self.images_np.astype(np.float32)).pin_memory()  # [n_images, H, W, 3], host
         self.images_gray = torch.from_numpy(self.images_gray_np.astype(np.float32)).cuda()
-        self.masks  = torch.from_numpy(self.masks_np.astype(np.float32)).to(self.device)
+        self.masks  = torch.from_numpy(self.masks_np.astype(np.float32)).pin_memory()  # [n_images, H, W, 3], host
+        self.image_pool = ImagePool(self.images, self.masks, self.image_pool_size, self.device)
         self.intrinsics_all = torch.stack(self.intrinsics_all).to(self.device)   # [n_images, 4, 4]
         self.intrinsics_all_inv = torch.inverse(self.intrinsics_all)  # [n_images, 4, 4]
         self.focal = self.intrinsics_all[0][0, 0]
@@ -158,15 +215,15 @@ class Dataset:
 
         pixels_x = torch.randint(low=0, high=self.W, size=[batch_size])
         pixels_y = torch.randint(low=0, high=self.H, size=[batch_size])
-        color = self.images[img_idx][(pixels_y, pixels_x)]    # batch_size, 3
-        mask = self.masks[img_idx][(pixels_y, pixels_x)]      # batch_size, 3
+        image, mask = self.image_pool.get(img_idx)
+        color = image[(pixels_y, pixels_x)]    # batch_size, 3
+        mask = mask[pixels_y, pixels_x, :1]    # batch_size, 1
         p = torch.stack([pixels_x, pixels_y, torch.ones_like(pixels_y)], dim=-1).float()  # batch_size, 3
         p = torch.matmul(self.intrinsics_all_inv[img_idx, None, :3, :3], p[:, :, None]).squeeze() # batch_size, 3
         rays_v = p / torch.linalg.norm(p, ord=2, dim=-1, keepdim=True)    # batch_size, 3
         rays_v = torch.matmul(self.pose_all[img_idx, None, :3, :3], rays_v[:, :, None]).squeeze()  # batch_size, 3
         rays_o = self.pose_all[img_idx, None, :3, 3].expand(rays_v.shape) # batch_size, 3
-        return torch.cat([rays_o.cpu(), rays_v.cpu(), color.cpu(), mask[:, :1].cpu()], dim=-1).cuda(), intrinsics_pair, intrinsics_inv_pair, poses_pair, images_gray_pair
- # batch_size, 10
+        return RayBatch(rays_o, rays_v, color, mask), intrinsics_pair, intrinsics_inv_pair, poses_pair, images_gray_pair
 
     def gen_rays_between(self, idx_0, idx_1, ratio, resolution_level=1):
         """
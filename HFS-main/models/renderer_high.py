@@ -270,7 +270,8 @@ class NeuSRenderer:
         pts = pts.reshape(-1, 3)
         dirs = dirs.reshape(-1, 3)
 
-        s = deviation_network(torch.zeros([1])).clip(1e-6, 1e3).detach()
+        with torch.autocast(device_type='cuda', enabled=False):
+            s = deviation_network(torch.zeros([1])).clip(1e-6, 1e3).detach()
 
         if sdf_network_high is None:
             sdf_nn_output = sdf_network(pts)
@@ -288,7 +289,8 @@ class NeuSRenderer:
 
         true_cos = (dirs * gradients).sum(-1, keepdim=True)
 
-        inv_s = deviation_network(torch.zeros([1, 3]))[:, :1].clip(1e-6, 1e6)           # Single parameter
+        with torch.autocast(device_type='cuda', enabled=False):
+            inv_s = deviation_network(torch.zeros([1, 3]))[:, :1].clip(1e-6, 1e6)           # Single parameter
 
         sigmoid_sdf = torch.sigmoid(s * sdf)
         weight_sdf = s * sigmoid_sdf * (1 - sigmoid_sdf)
@@ -327,96 +329,100 @@ class NeuSRenderer:
         if background_rgb is not None:    # Fixed background, usually black
             color = color + background_rgb * (1.0 - weights_sum)
 
-        # Eikonal loss
-        gradient_error = (torch.linalg.norm(gradients.reshape(batch_size, n_samples, 3), ord=2,
-                                            dim=-1) - 1.0) ** 2
-        gradient_error = (relax_inside_sphere * gradient_error).sum() / (relax_inside_sphere.sum() + 1e-5)
+        # Eikonal loss, kept in fp32 under mixed precision
+        with torch.autocast(device_type='cuda', enabled=False):
+            gradient_error = (torch.linalg.norm(gradients.float().reshape(batch_size, n_samples, 3), ord=2,
+                                                dim=-1) - 1.0) ** 2
+            gradient_error = (relax_inside_sphere * gradient_error).sum() / (relax_inside_sphere.sum() + 1e-5)
 
-        if sdf_network_high is not None:
-            # add gradient
-            gradient_error2 = (torch.linalg.norm(gradient.reshape(batch_size, n_samples, 3), ord=2,
-                                                 dim=-1) - 1.0) ** 2
-            gradient_error2 = (relax_inside_sphere * gradient_error2).sum() / (relax_inside_sphere.sum() + 1e-5)
+            if sdf_network_high is not None:
+                # add gradient
+                gradient_error2 = (torch.linalg.norm(gradient.float().reshape(batch_size, n_samples, 3), ord=2,
+                                                     dim=-1) - 1.0) ** 2
+                gradient_error2 = (relax_inside_sphere * gradient_error2).sum() / (relax_inside_sphere.sum() + 1e-5)
 
-            beta = 1 - (self.sdf_network.progress.data - 0.5) / 0.5
+                beta = 1 - (self.sdf_network.progress.data - 0.5) / 0.5
 
-            gradient_error = gradient_error + beta.clip(0.0, 1.0) * gradient_error2
+                gradient_error = gradient_error + beta.clip(0.0, 1.0) * gradient_error2
 
 
          # Updated by Qingshan
-        sdf_d = sdf.reshape(batch_size, n_samples)
-        prev_sdf, next_sdf = sdf_d[:, :-1], sdf_d[:, 1:]
-        sign = prev_sdf * next_sdf
-        sign = torch.where(sign <= 0, torch.ones_like(sign), torch.zeros_like(sign))
-        idx = reversed(torch.Tensor(range(1, n_samples)).cuda())
-        tmp = torch.einsum("ab,b->ab", (sign, idx))
-        prev_idx = torch.argmax(tmp, 1, keepdim=True)
-        next_idx = prev_idx + 1
-
-        prev_inside_sphere = torch.gather(inside_sphere, 1, prev_idx)
-        next_inside_sphere = torch.gather(inside_sphere, 1, next_idx)
-        mid_inside_sphere = (0.5 * (prev_inside_sphere + next_inside_sphere) > 0.5).float()
-        sdf1 = torch.gather(sdf_d, 1, prev_idx)
-        sdf2 = torch.gather(sdf_d, 1, next_idx)
-        z_vals1 = torch.gather(mid_z_vals, 1, prev_idx)
-        z_vals2 = torch.gather(mid_z_vals, 1, next_idx)
-        z_vals_sdf0 = (sdf1 * z_vals2 - sdf2 * z_vals1) / (sdf1 - sdf2 + 1e-10)
-        z_vals_sdf0 = torch.where(z_vals_sdf0 < 0, torch.zeros_like(z_vals_sdf0), z_vals_sdf0)
-        max_z_val = torch.max(z_vals)
-        z_vals_sdf0 = torch.where(z_vals_sdf0 > max_z_val, torch.zeros_like(z_vals_sdf0), z_vals_sdf0)
-        pts_sdf0 = rays_o[:, None, :] + rays_d[:, None, :] * z_vals_sdf0[..., :, None]  # [batch_size, 1, 3]
-        gradients_sdf0 = sdf_network.gradient(pts_sdf0.reshape(-1, 3)).squeeze().reshape(batch_size, 1, 3)
-        gradients_sdf0 = gradients_sdf0 / torch.linalg.norm(gradients_sdf0, ord=2, dim=-1, keepdim=True)
-        gradients_sdf0 = torch.matmul(poses[0, :3, :3].permute(1, 0)[None, ...], gradients_sdf0.permute(0, 2, 1)).permute(0, 2, 1).detach()
-
-        project_xyz = torch.matmul(poses[0, :3, :3].permute(1, 0), pts_sdf0.permute(0, 2, 1))
-        t = - torch.matmul(poses[0, :3, :3].permute(1, 0), poses[0, :3, 3, None])
-        project_xyz = project_xyz + t
-        pts_sdf0_ref = project_xyz
-        project_xyz = torch.matmul(intrinsics[0, :3, :3], project_xyz)  # [batch_size, 3, 1]
-        depth_sdf = project_xyz[:, 2, 0] * mid_inside_sphere.squeeze(1)
-        disp_sdf0 = torch.matmul(gradients_sdf0, pts_sdf0_ref)
-
-
-        # Compute Homography
-        K_ref_inv = intrinsics_inv[0, :3, :3]
-        K_src = intrinsics[1:, :3, :3]
-        num_src = K_src.shape[0]
-        R_ref_inv = poses[0, :3, :3]
-        R_src = poses[1:, :3, :3].permute(0, 2, 1)
-        C_ref = poses[0, :3, 3]
-        C_src = poses[1:, :3, 3]
-        R_relative = torch.matmul(R_src, R_ref_inv)
-        C_relative = C_ref[None, ...] - C_src
-        tmp = torch.matmul(R_src, C_relative[..., None])
-        tmp = torch.matmul(tmp[None, ...].expand(batch_size, num_src, 3, 1), gradients_sdf0.expand(batch_size, num_src, 3)[..., None].permute(0, 1, 3, 2))  # [Batch_size, num_src, 3, 1]
-        tmp = R_relative[None, ...].expand(batch_size, num_src, 3, 3) + tmp / (disp_sdf0[..., None] + 1e-10)
-        tmp = torch.matmul(K_src[None, ...].expand(batch_size, num_src, 3, 3), tmp)
-        Hom = torch.matmul(tmp, K_ref_inv[None, None, ...])
-
-        pixels_x = project_xyz[:, 0, 0] / (project_xyz[:, 2, 0] + 1e-8)
-        pixels_y = project_xyz[:, 1, 0] / (project_xyz[:, 2, 0] + 1e-8)
-        pixels = torch.stack([pixels_x, pixels_y], dim=-1).float()
-        patch_size = 5
-        total_size = (patch_size * 2 + 1) ** 2
-        offsets = self.update_patch_size(patch_size, rays_o.device)  # [1, 121, 2]
-        pixels_patch = pixels.view(batch_size, 1, 2) + offsets.float()  # [batch_size, 121, 2]
-
-        ref_image = images[0, :, :]
-        src_images = images[1:, :, :]
-        h, w = ref_image.shape
+        # Zero crossing, projection, homography and patch sampling stay in fp32 under mixed precision: in bf16 the
+        # focal length and pixel coordinates are quantised by several pixels, which misplaces the NCC patches.
+        with torch.autocast(device_type='cuda', enabled=False):
+            sdf_d = sdf.float().reshape(batch_size, n_samples)
+            prev_sdf, next_sdf = sdf_d[:, :-1], sdf_d[:, 1:]
+            sign = prev_sdf * next_sdf
+            sign = torch.where(sign <= 0, torch.ones_like(sign), torch.zeros_like(sign))
+            idx = reversed(torch.Tensor(range(1, n_samples)).cuda())
+            tmp = torch.einsum("ab,b->ab", (sign, idx))
+            prev_idx = torch.argmax(tmp, 1, keepdim=True)
+            next_idx = prev_idx + 1
+
+            prev_inside_sphere = torch.gather(inside_sphere, 1, prev_idx)
+            next_inside_sphere = torch.gather(inside_sphere, 1, next_idx)
+            mid_inside_sphere = (0.5 * (prev_inside_sphere + next_inside_sphere) > 0.5).float()
+            sdf1 = torch.gather(sdf_d, 1, prev_idx)
+            sdf2 = torch.gather(sdf_d, 1, next_idx)
+            z_vals1 = torch.gather(mid_z_vals.float(), 1, prev_idx)
+            z_vals2 = torch.gather(mid_z_vals.float(), 1, next_idx)
+            z_vals_sdf0 = (sdf1 * z_vals2 - sdf2 * z_vals1) / (sdf1 - sdf2 + 1e-10)
+            z_vals_sdf0 = torch.where(z_vals_sdf0 < 0, torch.zeros_like(z_vals_sdf0), z_vals_sdf0)
+            max_z_val = torch.max(z_vals)
+            z_vals_sdf0 = torch.where(z_vals_sdf0 > max_z_val, torch.zeros_like(z_vals_sdf0), z_vals_sdf0)
+            pts_sdf0 = rays_o.float()[:, None, :] + rays_d.float()[:, None, :] * z_vals_sdf0[..., :, None]  # [batch_size, 1, 3]
+            gradients_sdf0 = sdf_network.gradient(pts_sdf0.reshape(-1, 3)).squeeze().reshape(batch_size, 1, 3).float()
+            gradients_sdf0 = gradients_sdf0 / torch.linalg.norm(gradients_sdf0, ord=2, dim=-1, keepdim=True)
+            gradients_sdf0 = torch.matmul(poses[0, :3, :3].permute(1, 0)[None, ...], gradients_sdf0.permute(0, 2, 1)).permute(0, 2, 1).detach()
+
+            project_xyz = torch.matmul(poses[0, :3, :3].permute(1, 0), pts_sdf0.permute(0, 2, 1))
+            t = - torch.matmul(poses[0, :3, :3].permute(1, 0), poses[0, :3, 3, None])
+            project_xyz = project_xyz + t
+            pts_sdf0_ref = project_xyz
+            project_xyz = torch.matmul(intrinsics[0, :3, :3], project_xyz)  # [batch_size, 3, 1]
+            depth_sdf = project_xyz[:, 2, 0] * mid_inside_sphere.squeeze(1)
+            disp_sdf0 = torch.matmul(gradients_sdf0, pts_sdf0_ref)
+
+
+            # Compute Homography
+            K_ref_inv = intrinsics_inv[0, :3, :3]
+            K_src = intrinsics[1:, :3, :3]
+            num_src = K_src.shape[0]
+            R_ref_inv = poses[0, :3, :3]
+            R_src = poses[1:, :3, :3].permute(0, 2, 1)
+            C_ref = poses[0, :3, 3]
+            C_src = poses[1:, :3, 3]
+            R_relative = torch.matmul(R_src, R_ref_inv)
+            C_relative = C_ref[None, ...] - C_src
+            tmp = torch.matmul(R_src, C_relative[..., None])
+            tmp = torch.matmul(tmp[None, ...].expand(batch_size, num_src, 3, 1), gradients_sdf0.expand(batch_size, num_src, 3)[..., None].permute(0, 1, 3, 2))  # [Batch_size, num_src, 3, 1]
+            tmp = R_relative[None, ...].expand(batch_size, num_src, 3, 3) + tmp / (disp_sdf0[..., None] + 1e-10)
+            tmp = torch.matmul(K_src[None, ...].expand(batch_size, num_src, 3, 3), tmp)
+            Hom = torch.matmul(tmp, K_ref_inv[None, None, ...])
+
+            pixels_x = project_xyz[:, 0, 0] / (project_xyz[:, 2, 0] + 1e-8)
+            pixels_y = project_xyz[:, 1, 0] / (project_xyz[:, 2, 0] + 1e-8)
+            pixels = torch.stack([pixels_x, pixels_y], dim=-1).float()
+            patch_size = 5
+            total_size = (patch_size * 2 + 1) ** 2
+            offsets = self.update_patch_size(patch_size, rays_o.device)  # [1, 121, 2]
+            pixels_patch = pixels.view(batch_size, 1, 2) + offsets.float()  # [batch_size, 121, 2]
+
+            ref_image = images[0, :, :]
+            src_images = images[1:, :, :]
+            h, w = ref_image.shape
         
-        grid = self.patch_homography(Hom, pixels_patch)
-        grid[:, :, 0] = 2 * grid[:, :, 0] / (w - 1) - 1.0
-        grid[:, :, 1] = 2 * grid[:, :, 1] / (h - 1) - 1.0
-        sampled_gray_val = F.grid_sample(src_images.unsqueeze(1), grid.view(num_src, -1, 1, 2), align_corners=True)
-        sampled_gray_val = sampled_gray_val.view(num_src, batch_size, total_size, 1)  # [nsrc, batch_size, 121, 1]
-        pixels_patch[:, :, 0] = 2 * pixels_patch[:, :, 0] / (w - 1) - 1.0
-        pixels_patch[:, :, 1] = 2 * pixels_patch[:, :, 1] / (h - 1) - 1.0
-        grid = pixels_patch.detach()
-        ref_gray_val = F.grid_sample(ref_image[None, None, ...], grid.view(1, -1, 1, 2), align_corners=True)
-        ref_gray_val = ref_gray_val.view(1, batch_size, total_size, 1)
-        ncc = self.compute_LNCC(ref_gray_val, sampled_gray_val)
+            grid = self.patch_homography(Hom, pixels_patch)
+            grid[:, :, 0] = 2 * grid[:, :, 0] / (w - 1) - 1.0
+            grid[:, :, 1] = 2 * grid[:, :, 1] / (h - 1) - 1.0
+            sampled_gray_val = F.grid_sample(src_images.unsqueeze(1), grid.view(num_src, -1, 1, 2), align_corners=True)
+            sampled_gray_val = sampled_gray_val.view(num_src, batch_size, total_size, 1)  # [nsrc, batch_size, 121, 1]
+            pixels_patch[:, :, 0] = 2 * pixels_patch[:, :, 0] / (w - 1) - 1.0
+            pixels_patch[:, :, 1] = 2 * pixels_patch[:, :, 1] / (h - 1) - 1.0
+            grid = pixels_patch.detach()
+            ref_gray_val = F.grid_sample(ref_image[None, None, ...], grid.view(1, -1, 1, 2), align_corners=True)
+            ref_gray_val = ref_gray_val.view(1, batch_size, total_size, 1)
+            ncc = self.compute_LNCC(ref_gray_val, sampled_gray_val)
         ncc = ncc * mid_inside_sphere
 
 
@@ -1,22 +1,16 @@
 import re
+import numpy as np
 import matplotlib.pyplot as plt
 
 # Open and read the text file
 file_path = 'C:\\Users\\sande\\Documents\\3D_vision\\Project\\Final_results\\test_HFS_main\\exp\\scan106\\womask_hfs\\logs\\loss.txt'  # Replace with the actual path to your file
 with open(file_path, 'r') as file:
-    lines = file.readlines()
+    text = file.read()
 
-# Parse iterations and losses from each line
-iterations = []
-losses = []
-
-for line in lines:
-    match = re.search(r'iter:(\d+) loss = ([\d.]+)', line)
-    if match:
-        iter_num = int(match.group(1))
-        loss_val = float(match.group(2))
-        iterations.append(iter_num)
-        losses.append(loss_val)
+# Parse iterations and losses from the whole file in one pass
+records = np.array(re.findall(r'iter:(\d+) loss = ([\d.]+)', text), dtype=float).reshape(-1, 2)
+iterations = records[:, 0].astype(int)
+losses = records[:, 1]
 
 # Plotting
 plt.plot(iterations, losses, marker='o', linestyle='-', color='b')